@@ -0,0 +1,36 @@
+"""
+Cache Helper Functions
+
+Optional Redis cache for hot read endpoints. Caching is disabled when
+REDIS_URL is not set, so the API works without Redis. Cached bodies are read
+together with the collection versions (see versions.get_versions).
+"""
+
+import os
+from dotenv import load_dotenv
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+# Load environment variables from .env file
+load_dotenv()
+
+redis = None
+
+redis_url = os.getenv("REDIS_URL")
+
+if redis_url:
+    redis = Redis.from_url(redis_url)
+
+async def close_cache():
+    """Close the Redis connection pool"""
+    if redis is not None:
+        await redis.aclose()
+
+async def cache_set(key: str, value: bytes, ttl: int):
+    """Store value under key for ttl seconds, ignoring Redis errors"""
+    if redis is None:
+        return
+    try:
+        await redis.set(key, value, ex=ttl)
+    except RedisError:
+        pass
@@ -0,0 +1,62 @@
+"""
+CORS Middleware
+
+Minimal ASGI middleware allowing any origin, replacing Starlette's
+CORSMiddleware (origin matching and header parsing on every request) with a
+short-circuit for preflights and one header append for everything else.
+Origins are echoed back rather than sent as "*" so credentialed requests keep
+working, matching allow_origins=["*"], allow_credentials=True.
+"""
+
+PREFLIGHT_MAX_AGE = b"600"
+
+
+class SimpleCORSMiddleware:
+    """Allow all origins, methods and headers with credentials"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        origin = None
+        request_method = None
+        request_headers = None
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value
+            elif name == b"access-control-request-method":
+                request_method = value
+            elif name == b"access-control-request-headers":
+                request_headers = value
+
+        if origin is None:
+            await self.app(scope, receive, send)
+            return
+
+        cors_headers = [
+            (b"access-control-allow-origin", origin),
+            (b"access-control-allow-credentials", b"true"),
+            (b"vary", b"Origin"),
+        ]
+
+        if scope["method"] == "OPTIONS" and request_method is not None:
+            headers = cors_headers + [
+                (b"access-control-allow-methods", request_method),
+                (b"access-control-max-age", PREFLIGHT_MAX_AGE),
+            ]
+            if request_headers is not None:
+                headers.append((b"access-control-allow-headers", request_headers))
+            await send({"type": "http.response.start", "status": 204, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + cors_headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
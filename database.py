@@ -1,32 +1,68 @@
 """
 Database Helper Functions
 
-MongoDB helper functions ready to use in your backend code.
-Import and use these functions in your API endpoints for database operations.
+Async MongoDB helper functions (Motor) ready to use in your backend code.
+Import and await these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel
 from datetime import datetime, timezone
+import logging
 import os
 from dotenv import load_dotenv
-from typing import Union
+from typing import List, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 _client = None
 db = None
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
+# One client per process, shared by every request. The client must be created
+# after forking, so run multi-worker servers (e.g. gunicorn) without --preload
+# to give each worker its own pool.
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=20,
+        minPoolSize=5,
+        serverSelectionTimeoutMS=3000,
+        waitQueueTimeoutMS=2000,
+    )
     db = _client[database_name]
 
+def close_client():
+    """Close the shared client and its connection pool"""
+    if _client is not None:
+        _client.close()
+
+# Indexes backing the API's filters and sorts
+INDEXES = {
+    "piratemember": [IndexModel([("crew_id", ASCENDING)]), IndexModel([("bounty", DESCENDING)])],
+    "piratecrew": [IndexModel([("sea", ASCENDING), ("crew_of_month", ASCENDING)])],
+    "event": [IndexModel([("status", ASCENDING)])],
+}
+
+async def ensure_indexes():
+    """Create the indexes in INDEXES (no-op for ones that already exist), logging failures"""
+    if db is None:
+        return
+    try:
+        for collection_name, indexes in INDEXES.items():
+            await db[collection_name].create_indexes(indexes)
+    except Exception:
+        # an unreachable database must not stop the API (and /test) from starting
+        logger.exception("Failed to create indexes")
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -40,16 +76,36 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
+async def create_documents(collection_name: str, items: List[Union[BaseModel, dict]]):
+    """Insert many documents with timestamps in a single bulk write"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    docs = []
+    for data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data.copy()
+        data_dict['created_at'] = now
+        data_dict['updated_at'] = now
+        docs.append(data_dict)
+
+    result = await db[collection_name].insert_many(docs, ordered=False)
+    return [str(_id) for _id in result.inserted_ids]
+
+def find_documents(collection_name: str, filter_dict: dict = None, limit: int = None, projection: dict = None):
+    """Get an async cursor over documents in collection, optionally restricted to the projected fields"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
-    
-    cursor = db[collection_name].find(filter_dict or {})
+
+    cursor = db[collection_name].find(filter_dict or {}, projection)
     if limit:
         cursor = cursor.limit(limit)
-    
-    return list(cursor)
+    return cursor
+
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None, projection: dict = None):
+    """Get documents from collection, optionally restricted to the projected fields"""
+    cursor = find_documents(collection_name, filter_dict, limit, projection)
+    return await cursor.to_list(length=limit)
@@ -0,0 +1,59 @@
+"""
+Batch Loaders
+
+Coalesce lookups issued concurrently by separate requests into a single
+query per collection, DataLoader style. Requests that arrive within the same
+event-loop tick share one round trip.
+"""
+
+import asyncio
+from typing import Dict, List, Optional, Tuple
+from bson import ObjectId
+
+from database import db
+
+
+class CrewLoader:
+    """Load crews together with their members, batching concurrent calls"""
+
+    def __init__(self):
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def load(self, crew_oid: ObjectId) -> Tuple[Optional[dict], List[dict]]:
+        """Return (crew document or None, member documents) for crew_oid"""
+        key = str(crew_oid)
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            if self._task is None:
+                self._task = asyncio.create_task(self._dispatch())
+        # shield so one cancelled request doesn't cancel the result for the others
+        return await asyncio.shield(future)
+
+    async def _dispatch(self):
+        # yield once so every load() queued in this tick joins the batch
+        await asyncio.sleep(0)
+        batch, self._pending, self._task = self._pending, {}, None
+        try:
+            crews, members = await asyncio.gather(
+                db["piratecrew"].find({"_id": {"$in": [ObjectId(k) for k in batch]}}).to_list(length=None),
+                db["piratemember"].find({"crew_id": {"$in": list(batch)}}).to_list(length=None),
+            )
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        crews_by_id = {str(c["_id"]): c for c in crews}
+        members_by_crew: Dict[str, List[dict]] = {}
+        for m in members:
+            members_by_crew.setdefault(m["crew_id"], []).append(m)
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result((crews_by_id.get(key), members_by_crew.get(key, [])))
+
+
+crew_loader = CrewLoader()
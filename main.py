@@ -1,37 +1,86 @@
 import os
-from fastapi import FastAPI, HTTPException, Depends, Header
-from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import hmac
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from bson import ObjectId
 from datetime import datetime
+from pathlib import Path
+import orjson
 
-from database import db, create_document, get_documents
+from database import db, find_documents, ensure_indexes, close_client
 from schemas import Marine, PirateCrew, PirateMember, Event
+from cache import cache_set, close_cache
+from loaders import crew_loader
+from cors import SimpleCORSMiddleware
+from versions import create_document, create_documents, check_not_modified, cache_get_versioned, tag_cached
 
-app = FastAPI(title="Grandline - One Piece Fanverse API")
+app = FastAPI(title="Grandline - One Piece Fanverse API", default_response_class=ORJSONResponse)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+app.add_middleware(SimpleCORSMiddleware)
 
 
 # Utility
+DEFAULT_LIST_LIMIT = 50
+MAX_LIST_LIMIT = 500
+CREW_CACHE_TTL = 60
+LEADERBOARD_CACHE_TTL = 30
+
+
 class IdResponse(BaseModel):
     id: str
 
 
 def to_str_id(doc):
+    # mutates in place: the driver hands out a fresh dict per document
     if doc is None:
         return None
-    d = dict(doc)
-    if "_id" in d:
-        d["id"] = str(d.pop("_id"))
-    return d
+    oid = doc.pop("_id", None)
+    if oid is not None:
+        doc["id"] = str(oid)
+    return doc
+
+
+_HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+
+
+def parse_object_id(value: str, detail: str = "Invalid id") -> ObjectId:
+    """Parse a 24-char hex id, rejecting malformed input without raising inside bson"""
+    if len(value) != 24 or not _HEX_DIGITS.issuperset(value):
+        raise HTTPException(status_code=400, detail=detail)
+    return ObjectId(value)
+
+
+def stream_documents(cursor, headers: Optional[dict] = None):
+    """Stream a cursor as a JSON array, encoding one document at a time"""
+    async def body():
+        # one chunk per document, separator included, to keep ASGI sends down
+        prefix = b"["
+        async for doc in cursor:
+            yield prefix + orjson.dumps(to_str_id(doc), default=str)
+            prefix = b","
+        yield b"[]" if prefix == b"[" else b"]"
+    return StreamingResponse(body(), media_type="application/json", headers=headers)
+
+
+_background_tasks = set()
+
+
+@app.on_event("startup")
+async def create_indexes():
+    # run in the background so startup doesn't wait out server selection when
+    # the database is down; keep a reference so the task isn't garbage collected
+    task = asyncio.create_task(ensure_indexes())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+@app.on_event("shutdown")
+async def close_connections():
+    close_client()
+    await close_cache()
 
 
 @app.get("/")
@@ -56,7 +105,7 @@ async def test_database():
             response["database_name"] = db.name
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -70,13 +119,15 @@ async def test_database():
 
 # --- Admin auth ---
 ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "changeme")
+_ADMIN_TOKEN_BYTES = ADMIN_TOKEN.encode()
 
 
 def admin_required(authorization: Optional[str] = Header(None, alias="Authorization")):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid authorization header")
-    token = authorization.split(" ", 1)[1].strip()
-    if token != ADMIN_TOKEN:
+    token = authorization[7:].strip()
+    # constant-time comparison so response timing doesn't leak the token
+    if not hmac.compare_digest(token.encode(), _ADMIN_TOKEN_BYTES):
         raise HTTPException(status_code=403, detail="Forbidden")
     return True
 
@@ -84,151 +135,203 @@ def admin_required(authorization: Optional[str] = Header(None, alias="Authorizat
 # Marines
 @app.post("/api/marines", response_model=IdResponse, dependencies=[Depends(admin_required)])
 async def create_marine(marine: Marine):
-    new_id = create_document("marine", marine)
+    new_id = await create_document("marine", marine)
     return {"id": new_id}
 
 @app.get("/api/marines")
-async def list_marines(limit: Optional[int] = None):
-    docs = get_documents("marine", {}, limit)
-    return [to_str_id(d) for d in docs]
+async def list_marines(request: Request, limit: int = Query(DEFAULT_LIST_LIMIT, ge=1, le=MAX_LIST_LIMIT), full: bool = False):
+    not_modified, headers, _ = await check_not_modified(request, "marine")
+    if not_modified:
+        return not_modified
+    projection = None if full else {"bio": 0}
+    return stream_documents(find_documents("marine", {}, limit, projection), headers)
 
 
 # Pirate Crews
 @app.post("/api/crews", response_model=IdResponse, dependencies=[Depends(admin_required)])
 async def create_crew(crew: PirateCrew):
-    new_id = create_document("piratecrew", crew)
+    new_id = await create_document("piratecrew", crew)
     return {"id": new_id}
 
 @app.get("/api/crews")
-async def list_crews(sea: Optional[str] = None, crew_of_month: Optional[bool] = None):
+async def list_crews(
+    request: Request,
+    sea: Optional[str] = None,
+    crew_of_month: Optional[bool] = None,
+    full: bool = False,
+    limit: int = Query(DEFAULT_LIST_LIMIT, ge=1, le=MAX_LIST_LIMIT),
+):
+    not_modified, headers, _ = await check_not_modified(request, "piratecrew")
+    if not_modified:
+        return not_modified
     query = {}
     if sea:
         # exact match only, prevents operator injection
         query["sea"] = sea
     if crew_of_month is not None:
         query["crew_of_month"] = crew_of_month
-    docs = get_documents("piratecrew", query)
-    return [to_str_id(d) for d in docs]
+    projection = None if full else {"description": 0, "emblem_url": 0}
+    return stream_documents(find_documents("piratecrew", query, limit, projection), headers)
 
 @app.get("/api/crews/{crew_id}")
 async def get_crew(crew_id: str):
-    try:
-        doc = db["piratecrew"].find_one({"_id": ObjectId(crew_id)})
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid crew id")
+    oid = parse_object_id(crew_id, "Invalid crew id")
+    cache_key = f"crew:{oid}"
+    # the entry is tagged with the crew and member versions read before the
+    # load, so an entry written back after a concurrent write is never served
+    tag, cached = await cache_get_versioned(cache_key, "piratecrew", "piratemember")
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+    # concurrent get_crew calls are batched into one crew and one member query
+    doc, members = await crew_loader.load(oid)
     if not doc:
         raise HTTPException(status_code=404, detail="Crew not found")
-    crew = to_str_id(doc)
-    members = list(db["piratemember"].find({"crew_id": crew["id"]}))
-    crew["members"] = [to_str_id(m) for m in members]
-    return crew
+    # the loader shares documents between concurrent callers, so convert copies
+    crew = to_str_id(dict(doc))
+    crew["members"] = [to_str_id(dict(m)) for m in members]
+    content = orjson.dumps(crew, default=str)
+    if tag is not None:
+        await cache_set(cache_key, tag_cached(content, tag), CREW_CACHE_TTL)
+    return Response(content=content, media_type="application/json")
 
 
 # Pirate Members
 @app.post("/api/members", response_model=IdResponse, dependencies=[Depends(admin_required)])
 async def create_member(member: PirateMember):
     # ensure crew exists
-    try:
-        crew = db["piratecrew"].find_one({"_id": ObjectId(member.crew_id)})
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid crew id")
-    if not crew:
+    crew_oid = parse_object_id(member.crew_id, "Invalid crew id")
+    exists = await db["piratecrew"].count_documents({"_id": crew_oid}, limit=1)
+    if not exists:
         raise HTTPException(status_code=404, detail="Crew not found")
-    new_id = create_document("piratemember", member)
+    new_id = await create_document("piratemember", member)
     return {"id": new_id}
 
 @app.get("/api/members")
-async def list_members(crew_id: Optional[str] = None):
+async def list_members(request: Request, crew_id: Optional[str] = None, limit: int = Query(DEFAULT_LIST_LIMIT, ge=1, le=MAX_LIST_LIMIT)):
+    not_modified, headers, _ = await check_not_modified(request, "piratemember")
+    if not_modified:
+        return not_modified
     q = {"crew_id": crew_id} if crew_id else {}
-    docs = get_documents("piratemember", q)
-    return [to_str_id(d) for d in docs]
+    return stream_documents(find_documents("piratemember", q, limit), headers)
 
 
 # Events
 @app.post("/api/events", response_model=IdResponse, dependencies=[Depends(admin_required)])
 async def create_event(event: Event):
-    new_id = create_document("event", event)
+    new_id = await create_document("event", event)
     return {"id": new_id}
 
 @app.get("/api/events")
-async def list_events(status: Optional[str] = None):
+async def list_events(request: Request, status: Optional[str] = None, limit: int = Query(DEFAULT_LIST_LIMIT, ge=1, le=MAX_LIST_LIMIT)):
+    not_modified, headers, _ = await check_not_modified(request, "event")
+    if not_modified:
+        return not_modified
     q = {"status": status} if status else {}
-    docs = get_documents("event", q)
-    return [to_str_id(d) for d in docs]
+    return stream_documents(find_documents("event", q, limit), headers)
 
 @app.get("/api/events/{event_id}")
 async def get_event(event_id: str):
-    try:
-        doc = db["event"].find_one({"_id": ObjectId(event_id)})
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid event id")
+    doc = await db["event"].find_one({"_id": parse_object_id(event_id, "Invalid event id")})
     if not doc:
         raise HTTPException(status_code=404, detail="Event not found")
     return to_str_id(doc)
 
 
 # Leaderboard (top bounties)
+LEADERBOARD_FIELDS = {"name": 1, "bounty": 1, "crew_id": 1, "role": 1}
+
+
+def leaderboard_with_crew_pipeline(limit: int):
+    # $sort and $limit must stay first so the {bounty: -1} index serves the
+    # top-K scan; only the surviving documents go through $lookup/$project
+    return [
+        {"$sort": {"bounty": -1}},
+        {"$limit": limit},
+        {"$lookup": {
+            "from": "piratecrew",
+            # crew_id is stored as a string, piratecrew._id as an ObjectId
+            "let": {"crew_oid": {"$convert": {"input": "$crew_id", "to": "objectId", "onError": None, "onNull": None}}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$crew_oid"]}}},
+                {"$project": {"_id": 0, "name": 1}},
+            ],
+            "as": "crew",
+        }},
+        {"$project": {**LEADERBOARD_FIELDS, "crew_name": {"$arrayElemAt": ["$crew.name", 0]}}},
+    ]
+
+
 @app.get("/api/leaderboard")
-async def leaderboard(limit: int = 10):
-    # limit is int from query parameters, FastAPI parses safely
-    cursor = db["piratemember"].find({}).sort("bounty", -1).limit(limit)
-    return [to_str_id(d) for d in cursor]
+async def leaderboard(request: Request, limit: int = Query(10, ge=1, le=MAX_LIST_LIMIT), with_crew: bool = False):
+    collections = ("piratemember", "piratecrew") if with_crew else ("piratemember",)
+    cache_key = f"lb:{limit}:{'crew' if with_crew else 'plain'}"
+    # versions and the cached body come back in one Redis round trip
+    not_modified, headers, cached = await check_not_modified(request, *collections, cache_key=cache_key)
+    if not_modified:
+        return not_modified
+    if cached is not None:
+        return Response(content=cached, media_type="application/json", headers=headers)
+    if with_crew:
+        cursor = db["piratemember"].aggregate(leaderboard_with_crew_pipeline(limit))
+    else:
+        cursor = (
+            db["piratemember"]
+            .find({}, projection=LEADERBOARD_FIELDS)
+            .sort("bounty", -1)
+            .limit(limit)
+        )
+    content = orjson.dumps([to_str_id(d) async for d in cursor], default=str)
+    if "ETag" in headers:
+        await cache_set(cache_key, tag_cached(content, headers["ETag"]), LEADERBOARD_CACHE_TTL)
+    return Response(content=content, media_type="application/json", headers=headers)
 
 
 # --- Admin utilities ---
+# Static fixture, parsed once per process. Documents are already in their
+# stored shape (schema defaults filled in), so seeding skips model validation.
+# Members name their crew, resolved to the new crew id at insert time; events
+# get the seeding time as their date.
+SEEDS = orjson.loads(Path(__file__).with_name("seeds.json").read_bytes())
+
+
 class SeedResponse(BaseModel):
     created: dict
 
 @app.post("/api/admin/seed", response_model=SeedResponse, dependencies=[Depends(admin_required)])
 async def seed_data(force: bool = False):
     created = {"marines": 0, "crews": 0, "members": 0, "events": 0}
+    if force:
+        marine_count = crew_count = event_count = 0
+    else:
+        marine_count, crew_count, event_count = await asyncio.gather(
+            db["marine"].estimated_document_count(),
+            db["piratecrew"].estimated_document_count(),
+            db["event"].estimated_document_count(),
+        )
 
     # Seed Marines
-    if force or db["marine"].estimated_document_count() == 0:
-        marines = [
-            Marine(name="Sakazuki (Akainu)", rank="Fleet Admiral", bio="Absolute Justice proponent"),
-            Marine(name="Borsalino (Kizaru)", rank="Admiral", bio="Light-speed tactician"),
-        ]
-        for m in marines:
-            create_document("marine", m)
-            created["marines"] += 1
+    if marine_count == 0:
+        created["marines"] = len(await create_documents("marine", SEEDS["marine"]))
 
     # Seed Crews and Members
-    if force or db["piratecrew"].estimated_document_count() == 0:
-        crews = [
-            PirateCrew(name="Straw Hat Pirates", sea="Grand Line", description="Led by Monkey D. Luffy", crew_of_month=True),
-            PirateCrew(name="Red-Haired Pirates", sea="Grand Line", description="Crew of Emperor Shanks"),
-            PirateCrew(name="Arlong Pirates", sea="East Blue", description="Fish-man supremacists"),
-        ]
-        crew_ids = []
-        for c in crews:
-            cid = create_document("piratecrew", c)
-            crew_ids.append((c.name, cid))
-            created["crews"] += 1
-
-        # map crew names to ids
-        crew_map = {name: cid for name, cid in crew_ids}
+    if crew_count == 0:
+        crews = SEEDS["piratecrew"]
+        crew_ids = await create_documents("piratecrew", crews)
+        created["crews"] = len(crew_ids)
+
+        # map crew names to ids (inserted_ids follow input order)
+        crew_map = {c["name"]: cid for c, cid in zip(crews, crew_ids)}
         members = [
-            PirateMember(crew_id=crew_map["Straw Hat Pirates"], name="Monkey D. Luffy", role="Captain", bounty=3000000000),
-            PirateMember(crew_id=crew_map["Straw Hat Pirates"], name="Roronoa Zoro", role="Swordsman", bounty=1111000000),
-            PirateMember(crew_id=crew_map["Straw Hat Pirates"], name="Nami", role="Navigator", bounty=366000000),
-            PirateMember(crew_id=crew_map["Red-Haired Pirates"], name="Shanks", role="Captain", bounty=4048900000),
-            PirateMember(crew_id=crew_map["Arlong Pirates"], name="Arlong", role="Captain", bounty=20000000),
+            {"crew_id": crew_map[m["crew"]], **{k: v for k, v in m.items() if k != "crew"}}
+            for m in SEEDS["piratemember"]
         ]
-        for m in members:
-            create_document("piratemember", m)
-            created["members"] += 1
+        created["members"] = len(await create_documents("piratemember", members))
 
     # Seed Events
-    if force or db["event"].estimated_document_count() == 0:
+    if event_count == 0:
         now = datetime.utcnow()
-        events = [
-            Event(title="Battle of Marineford Anniversary", description="Commemoration event with trivia and duels", date=now, status="upcoming"),
-            Event(title="Grandline Cup", description="PvP tournament results posted", date=now, status="completed"),
-        ]
-        for e in events:
-            create_document("event", e)
-            created["events"] += 1
+        events = [{**e, "date": now} for e in SEEDS["event"]]
+        created["events"] = len(await create_documents("event", events))
 
     return {"created": created}
 
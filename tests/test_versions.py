@@ -0,0 +1,241 @@
+import asyncio
+import time
+from email.utils import formatdate
+
+import pytest
+from redis.exceptions import RedisError
+from starlette.requests import Request
+
+import database
+import versions
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.ops = []
+
+    def __getattr__(self, name):
+        def queue(*args):
+            self.ops.append((name, args))
+        return queue
+
+    async def execute(self):
+        if self.redis.down:
+            raise RedisError("connection refused")
+        return [getattr(self.redis, "_" + name)(*args) for name, args in self.ops]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def hset(self, key, field, value):
+        if self.down:
+            raise RedisError("connection refused")
+        return self._hset(key, field, value)
+
+    def _hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = str(value).encode()
+
+    def _hsetnx(self, key, field, value):
+        self.data.setdefault(key, {}).setdefault(field, str(value).encode())
+
+    def _hincrby(self, key, field, amount):
+        h = self.data.setdefault(key, {})
+        h[field] = str(int(h.get(field, b"0")) + amount).encode()
+
+    def _hmget(self, key, fields):
+        return [self.data.get(key, {}).get(f) for f in fields]
+
+    def _get(self, key):
+        return self.data.get(key)
+
+
+class FakeInsertResult:
+    inserted_id = "abc"
+
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    async def insert_one(self, doc):
+        self.db.inserted.append((self.name, doc))
+        return FakeInsertResult()
+
+    async def update_one(self, query, update, upsert=False):
+        if self.db.versions_down:
+            raise RuntimeError("versions unavailable")
+        doc = self.db.versions.setdefault(query["_id"], {"_id": query["_id"], "version": 0})
+        doc["version"] += update["$inc"]["version"]
+        doc["modified"] = update["$set"]["modified"].replace(tzinfo=None)
+
+    def find(self, query):
+        async def cursor():
+            for _id in query["_id"]["$in"]:
+                if _id in self.db.versions:
+                    yield self.db.versions[_id]
+        return cursor()
+
+
+class FakeDB:
+    def __init__(self):
+        self.inserted = []
+        self.versions = {}
+        self.versions_down = False
+
+    def __getitem__(self, name):
+        return FakeCollection(self, name)
+
+
+def make_request(**headers):
+    raw = [(k.replace("_", "-").encode(), v.encode()) for k, v in headers.items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw})
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(versions, "redis", fake)
+    monkeypatch.setattr(versions, "_epoch_dirty", False)
+    monkeypatch.setattr(versions, "_rotation_task", None)
+    monkeypatch.setattr(database, "db", FakeDB())
+    return fake
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    fake = FakeDB()
+    monkeypatch.setattr(versions, "redis", None)
+    monkeypatch.setattr(database, "db", fake)
+    return fake
+
+
+def check(*collections, **headers):
+    return asyncio.run(versions.check_not_modified(make_request(**headers), *collections))
+
+
+def test_no_validators_before_first_write(redis):
+    assert check("marine") == (None, {}, None)
+
+
+def test_if_none_match_returns_304(redis):
+    asyncio.run(versions.create_document("marine", {"name": "x"}))
+    _, headers, _ = check("marine")
+    not_modified, _, _ = check("marine", if_none_match=headers["ETag"])
+    assert not_modified.status_code == 304
+    # weak comparison: the strong form of the same tag also matches
+    not_modified, _, _ = check("marine", if_none_match=headers["ETag"][2:])
+    assert not_modified.status_code == 304
+
+
+def test_write_invalidates_etag(redis):
+    asyncio.run(versions.create_document("marine", {"name": "x"}))
+    _, headers, _ = check("marine")
+    asyncio.run(versions.create_document("marine", {"name": "y"}))
+    not_modified, new_headers, _ = check("marine", if_none_match=headers["ETag"])
+    assert not_modified is None
+    assert new_headers["ETag"] != headers["ETag"]
+
+
+def test_if_modified_since(redis):
+    asyncio.run(versions.create_document("marine", {"name": "x"}))
+    redis.data[versions.VERSIONS_KEY]["marine:modified"] = str(time.time() - 100).encode()
+    _, headers, _ = check("marine")
+    last_modified = headers["Last-Modified"]
+    not_modified, _, _ = check("marine", if_modified_since=last_modified)
+    assert not_modified.status_code == 304
+    not_modified, _, _ = check("marine", if_modified_since=formatdate(time.time() - 200, usegmt=True))
+    assert not_modified is None
+    # If-None-Match takes precedence over If-Modified-Since
+    not_modified, _, _ = check("marine", if_none_match='W/"other"', if_modified_since=last_modified)
+    assert not_modified is None
+
+
+def test_last_modified_withheld_within_write_second(redis):
+    asyncio.run(versions.create_document("marine", {"name": "x"}))
+    _, headers, _ = check("marine")
+    assert "ETag" in headers
+    assert "Last-Modified" not in headers
+
+
+def test_redis_bump_failure_does_not_fail_write(redis):
+    async def scenario():
+        await versions.create_document("marine", {"name": "x"})
+        _, headers, _ = await versions.check_not_modified(make_request(), "marine")
+        redis.down = True
+        assert await versions.create_document("marine", {"name": "y"}) == "abc"
+        assert len(database.db.inserted) == 2
+        redis.down = False
+        # this worker serves no validators until the epoch has been rotated
+        assert await versions.check_not_modified(make_request(), "marine") == (None, {}, None)
+        await versions._rotation_task
+        return headers
+
+    headers = asyncio.run(scenario())
+    not_modified, new_headers, _ = check("marine", if_none_match=headers["ETag"])
+    assert not_modified is None
+    assert new_headers["ETag"] != headers["ETag"]
+
+
+def test_failed_pre_bump_rotates_epoch_after_write(redis):
+    asyncio.run(versions.create_document("marine", {"name": "x"}))
+    _, headers, _ = check("marine")
+    epoch = redis.data[versions.VERSIONS_KEY]["_epoch"]
+
+    async def insert_with_pre_bump_failure():
+        redis.down = True
+        async with versions.recording_write("marine"):
+            redis.down = False
+    asyncio.run(insert_with_pre_bump_failure())
+    assert redis.data[versions.VERSIONS_KEY]["_epoch"] != epoch
+    assert versions._epoch_dirty is False
+    assert check("marine", if_none_match=headers["ETag"])[0] is None
+
+
+def test_mongo_pre_bump_failure_aborts_write(mongo):
+    mongo.versions_down = True
+    with pytest.raises(RuntimeError):
+        asyncio.run(versions.create_document("marine", {"name": "x"}))
+    assert mongo.inserted == []
+
+
+def test_mongo_post_bump_failure_keeps_write_and_invalidates(mongo):
+    asyncio.run(versions.create_document("marine", {"name": "x"}))
+    _, headers, _ = check("marine")
+
+    async def insert_with_post_bump_failure():
+        async with versions.recording_write("marine"):
+            await database.create_document("marine", {"name": "y"})
+            mongo.versions_down = True
+    asyncio.run(insert_with_post_bump_failure())
+    assert len(mongo.inserted) == 2
+    mongo.versions_down = False
+    # the pre-insert bump already moved the version on
+    assert check("marine", if_none_match=headers["ETag"])[0] is None
+
+
+def test_tagged_cache_rejects_stale_body(redis):
+    asyncio.run(versions.create_document("piratemember", {"name": "x"}))
+    tag, cached = asyncio.run(versions.cache_get_versioned("crew:1", "piratemember"))
+    assert cached is None
+    redis.data["crew:1"] = versions.tag_cached(b"old", tag)
+    assert asyncio.run(versions.cache_get_versioned("crew:1", "piratemember")) == (tag, b"old")
+    # a write moves the tag on, so the body written under the old tag is unreachable
+    asyncio.run(versions.create_document("piratemember", {"name": "y"}))
+    new_tag, cached = asyncio.run(versions.cache_get_versioned("crew:1", "piratemember"))
+    assert new_tag != tag
+    assert cached is None
+
+
+def test_untag_cached():
+    value = versions.tag_cached(b"body", 'W/"a-1"')
+    assert versions.untag_cached(value, 'W/"a-1"') == b"body"
+    assert versions.untag_cached(value, 'W/"a-2"') is None
+    assert versions.untag_cached(None, 'W/"a-1"') is None
@@ -0,0 +1,242 @@
+"""
+Collection Versions
+
+Per-collection write counters used for HTTP validators (ETag/Last-Modified)
+and to tag cached bodies. When Redis is configured they live in one Redis
+hash, shared by every worker and read in the same round trip as a cached
+body. Otherwise they live in the collection_versions MongoDB collection. The
+Redis hash carries a random epoch, written only by bumps, so counters that
+restart after Redis loses its data never repeat an old tag. Until the epoch
+exists, reads return no validators and no cached body.
+
+Every write bumps its collection's counter twice:
+  - before the insert, so validators issued earlier stop matching. With
+    MongoDB counters a failure here aborts the write before anything is
+    stored. A Redis failure never fails the write: this worker then serves
+    no validators or cached bodies until it has rotated the epoch.
+  - after the insert, for readers that saw the first bump but not the new
+    data. This bump is retried and never fails a committed write. If a Redis
+    bump still fails, or the first one did, the epoch is rotated in the
+    background until Redis accepts it, which invalidates every tag at once.
+Rotation only starts after the insert, so no reader can pair a new epoch
+with the data from before the write. With MongoDB counters, a stale 304 is
+possible only if every retry of the second bump fails, and then only for
+responses served between the two bumps, until the collection's next write.
+"""
+
+import asyncio
+import logging
+import secrets
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Optional, Tuple, Union
+
+from fastapi import Request
+from fastapi.responses import Response
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+
+import database
+from cache import redis
+
+logger = logging.getLogger(__name__)
+
+VERSIONS_COLLECTION = "collection_versions"
+VERSIONS_KEY = "collection_versions"
+VERSION_BUMP_ATTEMPTS = 3
+
+
+# set when a Redis bump fails, cleared once a new epoch has been written
+_epoch_dirty = False
+_rotation_task: Optional[asyncio.Task] = None
+
+
+async def _bump(collection_name: str):
+    if redis is not None:
+        global _epoch_dirty
+        rotate = _epoch_dirty
+        pipe = redis.pipeline(transaction=True)
+        if rotate:
+            pipe.hset(VERSIONS_KEY, "_epoch", secrets.token_hex(8))
+        else:
+            pipe.hsetnx(VERSIONS_KEY, "_epoch", secrets.token_hex(8))
+        pipe.hincrby(VERSIONS_KEY, collection_name, 1)
+        pipe.hset(VERSIONS_KEY, f"{collection_name}:modified", time.time())
+        await pipe.execute()
+        if rotate:
+            _epoch_dirty = False
+        return
+    await database.db[VERSIONS_COLLECTION].update_one(
+        {"_id": collection_name},
+        {"$inc": {"version": 1}, "$set": {"modified": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+
+
+async def _rotate_epoch():
+    """Write a new epoch, retrying with backoff until Redis accepts it"""
+    global _epoch_dirty, _rotation_task
+    delay = 0.1
+    while True:
+        try:
+            await redis.hset(VERSIONS_KEY, "_epoch", secrets.token_hex(8))
+            _epoch_dirty = False
+            _rotation_task = None
+            return
+        except RedisError:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+
+
+async def bump_version(collection_name: str):
+    """Record that a write to collection_name is about to happen"""
+    global _epoch_dirty
+    try:
+        await _bump(collection_name)
+    except RedisError:
+        # a cache outage must not fail the write; invalidate tags once it's stored
+        logger.warning("Failed to bump %s version before write", collection_name, exc_info=True)
+        _epoch_dirty = True
+
+
+async def bump_version_after_write(collection_name: str):
+    """Bump the version once the write is stored, retrying instead of raising"""
+    global _epoch_dirty, _rotation_task
+    for attempt in range(VERSION_BUMP_ATTEMPTS):
+        try:
+            await _bump(collection_name)
+            return
+        except Exception:
+            if attempt == VERSION_BUMP_ATTEMPTS - 1:
+                logger.exception("Failed to bump %s version after write", collection_name)
+            else:
+                await asyncio.sleep(0.05 * (attempt + 1))
+    if redis is not None:
+        _epoch_dirty = True
+        if _rotation_task is None:
+            _rotation_task = asyncio.create_task(_rotate_epoch())
+
+
+@asynccontextmanager
+async def recording_write(collection_name: str):
+    """Bump collection_name's version around the write in the block"""
+    await bump_version(collection_name)
+    try:
+        yield
+    finally:
+        await bump_version_after_write(collection_name)
+
+
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
+    """database.create_document, recorded in the collection's version"""
+    async with recording_write(collection_name):
+        return await database.create_document(collection_name, data)
+
+
+async def create_documents(collection_name: str, items: List[Union[BaseModel, dict]]):
+    """database.create_documents, recorded in the collection's version"""
+    async with recording_write(collection_name):
+        return await database.create_documents(collection_name, items)
+
+
+async def get_versions(collection_names: List[str], cache_key: str = None) -> Tuple[Optional[dict], Optional[bytes]]:
+    """Return ({"tag", "modified"} or None if unreadable, raw cached value at cache_key)"""
+    if redis is not None:
+        if _epoch_dirty:
+            return None, None
+        fields = ["_epoch"] + collection_names + [f"{c}:modified" for c in collection_names]
+        # read-only, so these reads can be served by a replica
+        pipe = redis.pipeline(transaction=False)
+        pipe.hmget(VERSIONS_KEY, fields)
+        if cache_key is not None:
+            pipe.get(cache_key)
+        try:
+            results = await pipe.execute()
+        except RedisError:
+            return None, None
+        values = [v.decode() if v is not None else None for v in results[0]]
+        if values[0] is None:
+            # no epoch until the first write records one: no validators, no cache
+            return None, None
+        n = len(collection_names)
+        counts = [v or "0" for v in values[1:n + 1]]
+        modified = [float(v) for v in values[n + 1:] if v is not None]
+        cached = results[1] if cache_key is not None else None
+        return {"tag": "-".join([values[0]] + counts), "modified": max(modified, default=None)}, cached
+
+    if database.db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    docs = {doc["_id"]: doc async for doc in database.db[VERSIONS_COLLECTION].find({"_id": {"$in": collection_names}})}
+    counts = [str(docs.get(c, {}).get("version", 0)) for c in collection_names]
+    # Motor returns naive datetimes, stored as UTC
+    modified = [d["modified"].replace(tzinfo=timezone.utc).timestamp() for d in docs.values() if d.get("modified")]
+    return {"tag": "-".join(counts), "modified": max(modified, default=None)}, None
+
+
+async def check_not_modified(request: Request, *collections: str, cache_key: str = None) -> Tuple[Optional[Response], dict, Optional[bytes]]:
+    """Return (304 response if the client's validators still match, validator headers, cached body at cache_key)"""
+    versions, cached = await get_versions(list(collections), cache_key)
+    if versions is None:
+        return None, {}, None
+    etag = f'W/"{versions["tag"]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    # HTTP dates have 1s resolution: a write later in the same second would
+    # reuse the date, so Last-Modified is only sent once that second is over
+    last_modified = None
+    if versions["modified"] is not None and int(versions["modified"]) < int(time.time()):
+        last_modified = int(versions["modified"])
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # weak comparison, as RFC 9110 requires for If-None-Match
+        tags = {t.strip() for t in if_none_match.split(",")}
+        tags = {t[2:] if t.startswith("W/") else t for t in tags}
+        fresh = "*" in tags or etag[2:] in tags
+    else:
+        # If-Modified-Since is only consulted without If-None-Match (RFC 9110 13.1.3)
+        since = parse_http_date(request.headers.get("if-modified-since"))
+        fresh = last_modified is not None and since is not None and since >= last_modified
+    if fresh:
+        return Response(status_code=304, headers=headers), headers, None
+    return None, headers, untag_cached(cached, etag)
+
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    """Parse an HTTP date header into a UTC timestamp, or None if absent or malformed"""
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+# Cached bodies are stored prefixed with the ETag they were built under, so a
+# body written back after a newer write is never served under the newer tag.
+def tag_cached(body: bytes, etag: str) -> bytes:
+    return etag.encode() + b"\n" + body
+
+
+def untag_cached(value: Optional[bytes], etag: str) -> Optional[bytes]:
+    if value is None:
+        return None
+    tag, _, body = value.partition(b"\n")
+    return body if tag == etag.encode() else None
+
+
+async def cache_get_versioned(cache_key: str, *collections: str) -> Tuple[Optional[str], Optional[bytes]]:
+    """Return (current version tag of collections, cached body built under it), or (None, None) without a cache"""
+    if redis is None:
+        return None, None
+    versions, cached = await get_versions(list(collections), cache_key)
+    if versions is None:
+        return None, None
+    tag = f'W/"{versions["tag"]}"'
+    return tag, untag_cached(cached, tag)